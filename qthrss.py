@@ -1,30 +1,73 @@
 import os
 import datetime
-import bs4
+import functools
 import jinja2
 import itertools
+import lxml.etree
+import lxml.html
 import logging
+import math
 import re
+import sqlite3
+import threading
+import time
 
+from typing import ClassVar
 from typing import override
 
+from requests.adapters import HTTPAdapter
 from requests_cache import CachedSession
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from urllib.parse import urljoin
+from lxml.cssselect import CSSSelector
 from urllib.parse import quote as urlquote
 from feedgen.feed import FeedGenerator
 from flask import Flask
 from flask import Response
+from flask import abort
 from flask import request
 from flask import jsonify
 
 LOG = logging.getLogger(__name__)
 CACHE_PATH = os.getenv("QTHRSS_CACHE_PATH", ".cache")
+TEMPLATE_CACHE_PATH = os.getenv("QTHRSS_TEMPLATE_CACHE_PATH")
 CACHE_LIFETIME = int(os.getenv("QTHRSS_CACHE_LIFETIME", 3600))
+CACHE_VACUUM_EVERY = int(os.getenv("QTHRSS_CACHE_VACUUM_EVERY", 24))
 ENTRIES_PER_CATEGORY = int(os.getenv("QTHRSS_ENTRIES_PER_CATEGORY", 20))
+FETCH_WORKERS = int(os.getenv("QTHRSS_FETCH_WORKERS", 8))
+FEED_MAX_AGE = int(os.getenv("QTHRSS_FEED_MAX_AGE", 300))
+USE_FEEDGEN = bool(int(os.getenv("QTHRSS_USE_FEEDGEN", 0)))
+CACHE_PRAGMAS = [
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+]
 
 
-@dataclass
+_html_parsers = threading.local()
+
+
+def html_parser(encoding: str) -> lxml.html.HTMLParser:
+    # lxml parsers must not be shared between threads, so each thread keeps
+    # its own parser per encoding.
+    parsers = _html_parsers.__dict__.setdefault("by_encoding", {})
+    if encoding not in parsers:
+        parsers[encoding] = lxml.html.HTMLParser(encoding=encoding)
+
+    return parsers[encoding]
+
+
+class CacheConnection(sqlite3.Connection):
+    """A sqlite connection tuned for the read-heavy response cache."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for pragma in CACHE_PRAGMAS:
+            self.execute(pragma)
+
+
+@dataclass(slots=True, frozen=True)
 class Category:
     url: str
     title: str
@@ -34,7 +77,7 @@ class Category:
         return self.title
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Listing:
     callsign: str
     id: str
@@ -47,92 +90,215 @@ class Listing:
     photo_url: str | None = None
 
 
+@dataclass(slots=True, frozen=True)
+class Feed:
+    id: str
+    title: str
+    link: str
+    description: str
+    listings: list[Listing]
+
+    @property
+    def updated(self) -> datetime.datetime:
+        # Date the feed by its newest listing rather than the time it was
+        # generated. Listing dates only have day precision, so this is only
+        # suitable for the Atom <updated> element, not for Last-Modified.
+        # An empty feed gets a fixed date so that its content, and so its
+        # ETag, stays the same between requests.
+        if not self.listings:
+            return datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+
+        return max(listing.updated or listing.published for listing in self.listings)
+
+
 class QTHRSS:
-    listings: dict[str, list[Listing]] = {}
-    categories: dict[str, Category] = {}
     entries_per_category = 20
-    base_url = "https://swap.qth.com"
-    category_listing_url = "index.php"
-    search_url = "search-results.php"
-    re_entry_metadata = re.compile(
+    # Rough number of listings on a category page; used to decide how many
+    # pages to request concurrently.
+    listings_per_page: ClassVar[int] = 10
+    base_url: ClassVar[str] = "https://swap.qth.com"
+    category_listing_url: ClassVar[str] = "index.php"
+    search_url: ClassVar[str] = "search-results.php"
+    re_entry_metadata: ClassVar[re.Pattern[str]] = re.compile(
         r"Listing #(?P<listingid>\d+) +- +Submitted on (?P<date_created>\d\d/\d\d/\d\d) "
         r"by Callsign (?P<callsign>[^ ,]+),? "
         r"(Modified on (?P<date_modified>\d\d/\d\d/\d\d),? )?"
-        r"(Web Site: (?P<website>[^ ]+ ))?"
-        r"(.*)"
+        r"(Web Site: (?P<website>[^ ]+ ))?",
+        re.ASCII,
     )
 
-    def __init__(self, entries_per_category=None):
+    # Match the innermost cell containing the heading; the page is laid out
+    # with nested tables.
+    xpath_category_header: ClassVar[lxml.etree.XPath] = lxml.etree.XPath(
+        "//td[contains(., 'VIEW BY CATEGORY') and not(.//td)]/.."
+    )
+    xpath_quick_search: ClassVar[lxml.etree.XPath] = lxml.etree.XPath(
+        "boolean(.//td[contains(., 'QUICK SEARCH') and not(.//td)])"
+    )
+    xpath_links: ClassVar[lxml.etree.XPath] = lxml.etree.XPath(".//a")
+    xpath_description_text: ClassVar[lxml.etree.XPath] = lxml.etree.XPath(
+        ".//text()[not(ancestor::a)]", smart_strings=False
+    )
+    select_category_dl: ClassVar[CSSSelector] = CSSSelector(".qth-content-wrap dl")
+    select_search_dl: ClassVar[CSSSelector] = CSSSelector("table dl")
+
+    def __init__(self, entries_per_category=None, fetch_workers=FETCH_WORKERS):
+        # The session is shared by the fetch workers; requests-cache serializes
+        # writes to the sqlite backend, and the timeout gives a worker room to
+        # wait for the write lock instead of failing.
         self.session = CachedSession(
-            CACHE_PATH, backend="sqlite", serializer="json", expire_after=CACHE_LIFETIME
+            CACHE_PATH,
+            backend="sqlite",
+            serializer="pickle",
+            expire_after=CACHE_LIFETIME,
+            check_same_thread=False,
+            timeout=30,
+            factory=CacheConnection,
+            wal=True,
+            fast_save=True,
         )
-        self.listings = {}
-        self.categories = {}
+        # requests keeps at most 10 connections per host by default. Grow the
+        # pool when there are more fetch workers than that, so that no worker
+        # has its connection discarded and reopened after each fetch.
+        adapter = HTTPAdapter(pool_maxsize=max(fetch_workers, 10))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=fetch_workers)
+        self.categories: dict[str, Category] = {}
+        self._categories_by_name: dict[str, Category] = {}
+        self._base_url_prefix = self.base_url.rstrip("/") + "/"
+        self._categories_fetched_at = 0.0
+        self._categories_lock = threading.Lock()
 
         if entries_per_category:
             self.entries_per_category = entries_per_category
 
-    def get_soup(
+    def _abs(self, href: str) -> str:
+        # Listing links are all relative to the site root, so this avoids
+        # the cost of a full urljoin for every link on a page.
+        if href.startswith(("http://", "https://")):
+            return href
+
+        return self._base_url_prefix + href.lstrip("/")
+
+    def get_tree(
         self, url: str, params: dict[str, str] | None = None
-    ) -> bs4.BeautifulSoup:
+    ) -> lxml.html.HtmlElement:
         url = urljoin(self.base_url, url)
         res = self.session.get(url, params=params)
         res.raise_for_status()
-        return bs4.BeautifulSoup(res.text, "lxml")
+
+        # Use the charset from the Content-Type header when there is one.
+        # Otherwise let libxml2 detect it from the document (e.g. a <meta
+        # charset>); res.encoding would be requests' ISO-8859-1 default for
+        # text/* and override that.
+        parser = None
+        if "charset=" in res.headers.get("Content-Type", "").lower():
+            try:
+                parser = html_parser(res.encoding)
+            except LookupError:
+                pass
+        return lxml.html.fromstring(res.content, parser=parser)
+
+    def _categories_fresh(self) -> bool:
+        return (
+            bool(self.categories)
+            and time.monotonic() - self._categories_fetched_at < CACHE_LIFETIME
+        )
 
     def get_categories(self) -> list[Category]:
-        soup = self.get_soup(self.category_listing_url)
+        # The category index rarely changes, so only re-parse it once the
+        # cached copy would have expired anyway.
+        if self._categories_fresh():
+            return
+
+        # Only wait for another thread's refresh on a cold start; otherwise
+        # keep serving the stale categories until the refresh finishes.
+        if not self._categories_lock.acquire(blocking=not self.categories):
+            return
+
+        try:
+            if self._categories_fresh():
+                return
+
+            tree = self.get_tree(self.category_listing_url)
+
+            header = self.xpath_category_header(tree)[0]
+
+            for row in header.itersiblings(tag=lxml.etree.Element):
+                if self.xpath_quick_search(row):
+                    break
+                links = self.xpath_links(row)
+                self.categories.update(
+                    {
+                        link.text_content().strip(): Category(
+                            url=link.get("href"), title=link.text_content().strip()
+                        )
+                        for link in links
+                    }
+                )
+            self._categories_by_name = {
+                name.casefold(): category for name, category in self.categories.items()
+            }
 
-        row = soup.find(
-            "td", string=lambda text: "VIEW BY CATEGORY" in text if text else None
-        ).parent
+            self._categories_fetched_at = time.monotonic()
+        finally:
+            self._categories_lock.release()
 
-        while True:
-            row = row.findNextSibling()
-            if row is None:
-                break
-            if row.find(
-                "td", string=lambda text: "QUICK SEARCH" in text if text else None
-            ):
-                break
-            links = row.findAll("a")
-            self.categories.update(
-                {
-                    link.text.strip(): Category(
-                        url=link["href"], title=link.text.strip()
-                    )
-                    for link in links
-                }
-            )
+    def find_category(self, category_name: str) -> Category | None:
+        # Fall back to a case-insensitive match for hand-typed feed URLs.
+        category = self.categories.get(category_name)
+        if category is None:
+            category = self._categories_by_name.get(category_name.casefold())
+
+        return category
 
     def get_listings_for_category(self, category_name: str):
         listings: list[Listing] = []
         category = self.categories[category_name]
 
-        page = itertools.count(start=1)
-        while len(listings) < self.entries_per_category:
-            batch = self._get_listings_for_category(category, page=next(page))
-            if not batch:
-                break
-            listings.extend(batch)
-
-        return listings
-
-    def _get_listings_for_category(self, category: Category, page: int = 1):
-        soup = self.get_soup(category.url, params={"page": page})
-        dl = soup.select(".qth-content-wrap dl")
+        # Fetch pages a window at a time so that the HTTP requests overlap,
+        # but collect the results in page order. No single page needs to
+        # produce more than the number of entries still missing.
+        pages = itertools.count(start=1)
+        while (needed := self.entries_per_category - len(listings)) > 0:
+            window = math.ceil(needed / self.listings_per_page) + 1
+            batches = self.executor.map(
+                lambda page: self._get_listings_for_category(
+                    category, page=page, limit=needed
+                ),
+                itertools.islice(pages, window),
+            )
+            for batch in batches:
+                if not batch:
+                    return listings
+                listings.extend(batch)
+                if len(listings) >= self.entries_per_category:
+                    break
+
+        return listings[: self.entries_per_category]
+
+    def _get_listings_for_category(
+        self, category: Category, page: int = 1, limit: int | None = None
+    ):
+        tree = self.get_tree(category.url, params={"page": page})
+        dl = self.select_category_dl(tree)
         if not dl:
             return []
 
-        return self.listings_from_dl(dl)
+        return self.listings_from_dl(dl[0], limit=limit)
 
-    def listings_from_dl(self, dl):
+    def listings_from_dl(self, dl, limit: int | None = None):
         listings: list[Listing] = []
-        for child in dl[0].findChildren(recursive=False):
-            if child.name == "dt":
-                title = child.text.strip()
-            elif child.name == "dd":
-                description = child.text.splitlines()[:2]
+        for child in dl.iterchildren("dt", "dd"):
+            if limit is not None and len(listings) >= limit:
+                break
+            if child.tag == "dt":
+                title = child.text_content().strip()
+            elif child.tag == "dd":
+                # Only the first two lines are needed, so don't split the rest.
+                text = "".join(self.xpath_description_text(child))
+                description = text.split("\n", 2)[:2]
                 published = None
                 updated = None
                 if mo := self.re_entry_metadata.search("\n".join(description)):
@@ -163,8 +329,15 @@ class QTHRSS:
                     LOG.error("unexpected data format (%s)", title)
                     continue
 
-                contact_url = child.find("a", string="Click to Contact")
-                photo_url = child.find("a", string="Click Here to View Picture")
+                links: dict[str, str] = {}
+                for link in self.xpath_links(child):
+                    links.setdefault(link.text_content().strip(), link.get("href"))
+
+                contact_url = links.get("Click to Contact")
+                if contact_url is None:
+                    LOG.error("missing contact link (%s)", title)
+                    continue
+                photo_url = links.get("Click Here to View Picture")
                 listings.append(
                     Listing(
                         id=id,
@@ -172,23 +345,32 @@ class QTHRSS:
                         published=published,
                         updated=updated,
                         description="\n".join(description),
-                        contact_url=urljoin(self.base_url, contact_url["href"]),
-                        view_url=urljoin(
-                            self.base_url,
-                            contact_url["href"].replace("contact", "view_ad"),
+                        contact_url=self._abs(contact_url),
+                        view_url=self._abs(
+                            contact_url.replace("contact", "view_ad", 1)
                         ),
                         callsign=callsign,
-                        photo_url=urljoin(self.base_url, photo_url["href"])
-                        if photo_url
-                        else None,
+                        photo_url=self._abs(photo_url) if photo_url else None,
                     )
                 )
 
         return listings
 
+    def feedgen_for(self, feed: Feed) -> FeedGenerator:
+        fg = FeedGenerator()
+        fg.id(feed.id)
+        fg.title(feed.title)
+        fg.link(href=feed.link, rel="alternate")
+        fg.description(feed.description)
+        fg.updated(feed.updated)
+
+        self.add_feed_entries(fg, feed.listings)
+
+        return fg
+
     def add_feed_entries(self, feed, listings):
         for listing in listings:
-            entry = feed.add_entry()
+            entry = feed.add_entry(order="append")
             entry.guid(listing.view_url)
             entry.title(listing.title)
             entry.published(listing.published)
@@ -198,49 +380,106 @@ class QTHRSS:
             entry.link(href=listing.contact_url, rel="related")
             entry.content(listing.description, type="html")
 
-    def feed_for(self, category_name: str):
-        category = self.categories[category_name]
-
-        feed = FeedGenerator()
-        feed.id(category.url)
-        feed.title(f"QTH Classifieds - {category.title}")
-        feed.link(href=category.url, rel="alternate")
-        feed.description(category.title)
-
-        self.add_feed_entries(feed, self.get_listings_for_category(category.title))
-
-        return feed
+    def feed_for(self, category_name: str) -> Feed:
+        category = self.find_category(category_name)
+        if category is None:
+            abort(404)
+
+        return Feed(
+            id=category.url,
+            title=f"QTH Classifieds - {category.title}",
+            link=category.url,
+            description=category.title,
+            listings=self.get_listings_for_category(category.title),
+        )
 
-    def simple_search_feed(self, query: str):
+    def simple_search_feed(self, query: str) -> Feed:
         # This is only for display purposes
         search_url = f"https://swap.qth.com/search-results.php?keywords={query}&fieldtosearch=titleordesc"
 
-        feed = FeedGenerator()
-        feed.id(search_url)
-        feed.title(f"QTH Classifieds - Search - {query}")
-        feed.link(href=search_url, rel="alternate")
-        feed.description(f"Search for {query}")
-
-        self.add_feed_entries(feed, self.simple_search(query))
-
-        return feed
+        return Feed(
+            id=search_url,
+            title=f"QTH Classifieds - Search - {query}",
+            link=search_url,
+            description=f"Search for {query}",
+            listings=self.simple_search(query),
+        )
 
     def simple_search(self, query: str):
         # https://swap.qth.com/search-results.php?keywords=tm-v71&fieldtosearch=titleordesc
-        soup = self.get_soup(
+        tree = self.get_tree(
             self.search_url, params={"keywords": query, "fieldtosearch": "titleordesc"}
         )
-        dl = soup.select("table dl")
+        dl = self.select_search_dl(tree)
         if not dl:
             return []
 
-        return self.listings_from_dl(dl)
+        return self.listings_from_dl(dl[0])
+
+
+def evict_expired_responses(session: CachedSession):
+    # requests-cache only drops expired responses when they are looked up
+    # again, so without this the cache grows for as long as the app runs.
+    for count in itertools.count(start=1):
+        time.sleep(CACHE_LIFETIME)
+        try:
+            # A CACHE_VACUUM_EVERY of 0 disables vacuuming.
+            vacuum = CACHE_VACUUM_EVERY > 0 and count % CACHE_VACUUM_EVERY == 0
+            session.cache.delete(expired=True, vacuum=vacuum)
+        except Exception:
+            LOG.exception("failed to evict expired responses")
+
+
+def template_bytecode_cache() -> jinja2.BytecodeCache | None:
+    # Without an explicit path, jinja2 picks a per-user temporary directory.
+    # The cache is only an optimization, so carry on without it if the
+    # directory can't be created.
+    try:
+        if TEMPLATE_CACHE_PATH:
+            os.makedirs(TEMPLATE_CACHE_PATH, exist_ok=True)
+            return jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE_PATH)
+
+        return jinja2.FileSystemBytecodeCache()
+    except (OSError, RuntimeError):
+        LOG.warning("template bytecode cache unavailable", exc_info=True)
+        return None
 
 
 def create_app():
     app = Flask(__name__)
     qth = QTHRSS(entries_per_category=ENTRIES_PER_CATEGORY)
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader("templates"))
+    threading.Thread(
+        target=evict_expired_responses, args=(qth.session,), daemon=True
+    ).start()
+    # Templates only change on deploy, so don't stat them on every render,
+    # and keep compiled bytecode around for the next process start.
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader("templates"),
+        auto_reload=False,
+        bytecode_cache=template_bytecode_cache(),
+    )
+    feeds_template = env.get_template("feeds.html")
+    atom_template = env.get_template("atom.xml")
+
+    def render_atom(feed: Feed) -> bytes:
+        if USE_FEEDGEN:
+            return qth.feedgen_for(feed).atom_str(pretty=False)
+
+        return atom_template.render(feed=feed).encode("utf-8")
+
+    # The epoch argument changes every CACHE_LIFETIME seconds, so a rendered
+    # feed is reused for as long as the pages it was built from are cached.
+    @functools.lru_cache(maxsize=256)
+    def render_category_feed(category_name: str, epoch: int) -> bytes:
+        return render_atom(qth.feed_for(category_name))
+
+    def atom_response(body: bytes):
+        # Conditional requests are answered from the ETag alone; the listing
+        # dates are too coarse to use as a Last-Modified time.
+        res = Response(body, mimetype="application/atom+xml")
+        res.cache_control.max_age = FEED_MAX_AGE
+        res.add_etag()
+        return res.make_conditional(request)
 
     @app.before_request
     def update_categories():
@@ -248,9 +487,8 @@ def create_app():
 
     @app.route("/")
     def feeds():
-        t = env.get_template("feeds.html")
         caturls = {cat: f"{urlquote(cat)}" for cat in qth.categories}
-        return t.render(categories=caturls)
+        return feeds_template.render(categories=caturls)
 
     @app.route("/feeds.txt")
     def feeds_txt():
@@ -262,13 +500,19 @@ def create_app():
 
     @app.route("/feed/<path:category_name>")
     def atom_feed_for(category_name: str, kind: str = "atom"):
-        feed = qth.feed_for(category_name)
-        return Response(feed.atom_str(pretty=True), mimetype="application/atom+xml")
+        # Key the cache on the canonical title, so that differently cased
+        # URLs for the same category share one rendered feed.
+        category = qth.find_category(category_name)
+        if category is None:
+            abort(404)
+
+        epoch = int(time.monotonic() // CACHE_LIFETIME)
+        return atom_response(render_category_feed(category.title, epoch))
 
     @app.route("/search/<keyword>")
     def search(keyword: str):
         feed = qth.simple_search_feed(keyword)
-        return Response(feed.atom_str(pretty=True), mimetype="application/atom+xml")
+        return atom_response(render_atom(feed))
 
     @app.route("/cache")
     def cacheinfo():